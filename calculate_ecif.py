@@ -9,8 +9,11 @@ NOTE: Please ignore any AtomValenceExceptions that RDKit might produce.
 
 import argparse
 import csv
+import multiprocessing
 import os
 import sys
+from functools import partial
+from typing import Union
 
 import pandas as pd
 from ECIF import ecif
@@ -33,6 +36,16 @@ def parse_args():
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
 
+    parser.add_argument('--format', required=False, choices=['csv', 'feather', 'parquet'], default='csv',
+                        help='File format to write the computed descriptors in. feather and parquet are much faster'
+                             'to read and write than csv and produce smaller files, but require the pyarrow package.'
+                             'Defaults to csv.')
+    parser.add_argument('--combined', required=False, action='store_true',
+                        help='Write the descriptors for all cutoffs into a single wide table instead of one file per'
+                             'cutoff. Only has an effect if --cutoff is omitted; --output is then interpreted as a'
+                             'file name again. Descriptor columns are prefixed with their cutoff, e.g.'
+                             '"6.0/C;4;1;3;0;0-C;4;1;3;0;0", so one cutoff block can be selected with'
+                             'DataFrame.filter(like="6.0/").')
     parser.add_argument('--cutoff', required=False, metavar='FLOAT', type=float,
                         help='Distance cutoff for ECIF calculation. two atoms must not exceed to be counted as pair.'
                              'If --cutoff is omitted, descriptors for all cutoffs from 4.0 to 15.0 A are computed (in'
@@ -64,7 +77,54 @@ def parse_args():
     return parser.parse_args()
 
 
-def main(receptor_file: str, pose_file: str,  cutoff: float, output_file: str) -> None:
+def compute_descriptors(pair_group: dict, cutoffs: list) -> Union[dict, None]:
+    """
+    Calculates ECIF::LD descriptors for all poses of one receptor, for all requested
+    cutoffs, and returns them as dict mapping cutoff to descriptor DataFrame. Passing
+    all poses to ecif.get_ecif_ld in a single call lets it parse the receptor PDB only
+    once instead of once per pose; handling all cutoffs here means each pair group is
+    dispatched only once for the whole cutoff sweep. Pairs with missing files have
+    already been dropped in main(); the FileNotFoundError guard only remains as safety
+    net against files disappearing mid-run, in which case the group is skipped with a
+    warning and None is returned. Must be a top-level function to be picklable for
+    multiprocessing.
+    """
+    poses, pose_ranks = pair_group['POSE'], pair_group['POSERANK']
+
+    descriptors_per_cutoff = {}
+    for cutoff in cutoffs:
+        try:
+            descriptors = ecif.get_ecif_ld(receptor_files=pair_group['RECEPTOR'], ligand_files=poses, cutoff=cutoff)
+        except FileNotFoundError as e:
+            print_warning(f'{e}. Skipped.')
+            return None
+
+        # attach ID and pose ranks to descriptors for nicer output
+        descriptors.insert(0, 'POSERANK', pose_ranks)
+        descriptors.insert(0, 'ID', pair_group['ID'])
+        descriptors_per_cutoff[cutoff] = descriptors
+
+    return descriptors_per_cutoff
+
+
+def write_output(result: pd.DataFrame, output_file: str, output_format: str) -> None:
+    """
+    Writes descriptors to output_file in the requested format. feather and parquet
+    are handled by pyarrow, which is an optional dependency.
+    """
+    try:
+        if output_format == 'feather':
+            result.to_feather(output_file)
+        elif output_format == 'parquet':
+            result.to_parquet(output_file, compression='zstd')
+        else:
+            result.to_csv(output_file, index=False)
+    except ImportError:
+        print_error_and_exit(f'Writing {output_format} files requires the pyarrow package.')
+
+
+def main(receptor_file: str, pose_file: str,  cutoff: float, output_file: str, output_format: str = 'csv',
+         combined: bool = False) -> None:
 
     # Check if input files exists
     for f in [receptor_file, pose_file]:
@@ -79,17 +139,20 @@ def main(receptor_file: str, pose_file: str,  cutoff: float, output_file: str) -
         except IOError as e:
             print_error_and_exit(e)
 
-    if not cutoff:
-        if not os.path.isdir(args.output):
+    if not cutoff and not combined:
+        if not os.path.isdir(output_file):
             try:
-                os.makedirs(args.output, exist_ok=True)
+                os.makedirs(output_file, exist_ok=True)
             except IOError as e:
                 print_error_and_exit(e)
 
     # Load input CSVs into data frames and merge on ID
     try:
-        receptors = pd.read_csv(receptor_file, usecols=['ID', 'RECEPTOR'])
-        poses = pd.read_csv(pose_file, usecols=['ID', 'POSE', 'POSERANK'])
+        # Explicit dtypes spare pandas the per-column type inference.
+        receptors = pd.read_csv(receptor_file, usecols=['ID', 'RECEPTOR'],
+                                dtype={'ID': 'string', 'RECEPTOR': 'string'})
+        poses = pd.read_csv(pose_file, usecols=['ID', 'POSE', 'POSERANK'],
+                            dtype={'ID': 'string', 'POSE': 'string', 'POSERANK': 'int32'})
     except ValueError as e:
         print_error_and_exit(f'Could not load input file: {e}')
 
@@ -99,36 +162,67 @@ def main(receptor_file: str, pose_file: str,  cutoff: float, output_file: str) -
 
     receptor_ligand_pairs = receptors.merge(poses, on='ID')
 
+    # Drop pairs with missing files up front, with a single warning per missing file,
+    # so the workers don't repeat the check (and, before this existed, a failed RDKit
+    # call) for every cutoff of the sweep.
+    receptor_exists = receptor_ligand_pairs.RECEPTOR.map(os.path.isfile)
+    pose_exists = receptor_ligand_pairs.POSE.map(os.path.isfile)
+    for missing in pd.concat([receptor_ligand_pairs.RECEPTOR[~receptor_exists],
+                              receptor_ligand_pairs.POSE[~pose_exists]]).unique():
+        print_warning(f'No such file: {missing}. Skipped.')
+    receptor_ligand_pairs = receptor_ligand_pairs[receptor_exists & pose_exists]
+
+    # Group poses by receptor, so each receptor only has to be parsed once for all its
+    # poses (typically many poses share one receptor in a docking screen).
+    pose_groups = receptor_ligand_pairs \
+        .groupby(['ID', 'RECEPTOR'], sort=True) \
+        .agg(list) \
+        .reset_index() \
+        .to_dict('records')
+
     if not cutoff:
         cutoffs = [round(x / 10, 1) for x in range(40, 155, 5)]  # [4,15] in 0.5 steps
     else:
         cutoffs = [cutoff]
 
-    for cutoff in cutoffs:
-        list_of_descriptor_dfs = []
-        for pair in receptor_ligand_pairs.itertuples(index=False):
-            # Calculate ECIF::LD descriptors
-            try:
-                descriptors = ecif.get_ecif_ld(receptor_files=pair.RECEPTOR, ligand_files=pair.POSE, cutoff=cutoff)
-            except FileNotFoundError as e:
-                print_warning(f'{e}. Skipped.')
-                continue
-
-            # attach ID and pose rank to descriptors for nicer output
-            descriptors = pd.concat(
-                [pd.DataFrame({'ID': [pair.ID], 'POSERANK': [pair.POSERANK]}), descriptors],
-                axis='columns')
-            list_of_descriptor_dfs.append(descriptors)
-
-        result = pd.concat(list_of_descriptor_dfs, axis='index', ignore_index=True)
-
+    # Pair groups are independent of each other, so they can be processed in parallel.
+    # Each worker handles all cutoffs for its group at once.
+    pool = multiprocessing.Pool(os.cpu_count())
+
+    list_of_descriptor_dfs = {cutoff: [] for cutoff in cutoffs}
+    for descriptors_per_cutoff in pool.imap_unordered(partial(compute_descriptors, cutoffs=cutoffs), pose_groups):
+        if descriptors_per_cutoff is None:
+            continue
+        for cutoff, descriptors in descriptors_per_cutoff.items():
+            list_of_descriptor_dfs[cutoff].append(descriptors)
+
+    pool.close()
+
+    results = {
+        cutoff: pd.concat(list_of_descriptor_dfs[cutoff], axis='index', ignore_index=True)
+        for cutoff in cutoffs
+    }
+
+    if len(cutoffs) > 1 and combined:
+        # One wide table with a cutoff-prefixed column block per cutoff. Rows are
+        # aligned across cutoffs, because every worker returns its group's poses in
+        # the same order for each cutoff.
+        blocks = [results[cutoffs[0]][['ID', 'POSERANK']]]
+        blocks += [
+            results[cutoff].drop(columns=['ID', 'POSERANK']).add_prefix(f'{cutoff}/')
+            for cutoff in cutoffs
+        ]
+        write_output(pd.concat(blocks, axis='columns'), output_file, output_format)
+    elif len(cutoffs) > 1:
         # Treat output as directory, if no cutoff was specified.
-        if len(cutoffs) > 1:
-            output_file = os.path.join(output_file, f'ECIF_LD_{cutoff}.csv')
-
-        result.to_csv(output_file, index=False)
+        for cutoff in cutoffs:
+            write_output(results[cutoff], os.path.join(output_file, f'ECIF_LD_{cutoff}.{output_format}'),
+                         output_format)
+    else:
+        write_output(results[cutoffs[0]], output_file, output_format)
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(receptor_file=args.receptors, pose_file=args.poses, cutoff=args.cutoff, output_file=args.output)
+    main(receptor_file=args.receptors, pose_file=args.poses, cutoff=args.cutoff, output_file=args.output,
+         output_format=args.format, combined=args.combined)
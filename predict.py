@@ -2,14 +2,19 @@
 Predicts binding affinity for given descriptors using the specified trained model.
 """
 import os
-import pickle
 import sys
 from argparse import ArgumentParser, Namespace
+from collections import defaultdict
 from typing import Any
 
+import joblib
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
+# Number of rows predicted at a time; bounds peak memory for large screening batches.
+CHUNK_SIZE = 100_000
+
 
 def parse_args() -> Namespace:
     """
@@ -20,7 +25,8 @@ def parse_args() -> Namespace:
     required.add_argument(
         '--model', required=True, type=str, metavar='FILE',
         help='Trained model to make predictions with. Must implement a predict(X) method like sklearn\'s predictors.'
-             'Must be saved in binary format as produced by pickle.dump().')
+             'Must be saved in binary format as produced by joblib.dump() (models saved with pickle.dump() also'
+             'work).')
     required.add_argument(
         '--descriptors', required=True, type=str, metavar='FILE',
         help='ECIF::LD descriptors to predict binding affinity for (CSV format). All columns except "Receptor" and'
@@ -28,12 +34,19 @@ def parse_args() -> Namespace:
              'those used to train the model.')
     required.add_argument(
         '--output', required=True, type=str, metavar='FILE', help='Path to write results to')
+    parser.add_argument(
+        '--format', required=False, choices=['csv', 'feather', 'parquet'], default='csv',
+        help='File format of the --descriptors input file. feather and parquet are much faster to read than csv, but'
+             'require the pyarrow package. Defaults to csv.')
     return parser.parse_args()
 
 
 def load_model(file: str) -> Any:
-    with open(file, 'rb') as f:
-        model = pickle.load(f)
+    # mmap_mode maps the NumPy arrays inside the estimator (e.g. the forest's leaf
+    # values) into memory instead of copying them, which cuts startup time and RSS for
+    # large models. Models saved with plain pickle load fine as well, just without the
+    # mapping.
+    model = joblib.load(file, mmap_mode='r')
 
     # Verify that the model really has a predict method.
     if not callable(getattr(model, 'predict', None)):
@@ -42,8 +55,28 @@ def load_model(file: str) -> Any:
     return model
 
 
-def load_descriptors(file: str) -> DataFrame:
-    return pd.read_csv(file)
+def load_descriptors(file: str, file_format: str = 'csv') -> DataFrame:
+    """
+    Reads descriptors in the given format. feather and parquet are handled by pyarrow,
+    which is an optional dependency.
+    """
+    try:
+        if file_format == 'feather':
+            descriptors = pd.read_feather(file)
+        elif file_format == 'parquet':
+            descriptors = pd.read_parquet(file, engine='pyarrow')
+        else:
+            # Explicit dtypes spare pandas the per-column type inference on the wide
+            # descriptor table; the descriptor columns themselves are covered by the
+            # defaultdict, since their names are generated by ECIF.
+            return pd.read_csv(file, dtype=defaultdict(lambda: 'float32', Receptor='string', Ligand='string'))
+    except ImportError:
+        print_error_and_exit(f'Reading {file_format} files requires the pyarrow package.')
+
+    # Columnar input files may carry wider types; downcast to the float32 layout the
+    # model gets fed anyway, halving the memory of the loaded frame.
+    numeric_columns = descriptors.select_dtypes('number').columns
+    return descriptors.astype({col: 'float32' for col in numeric_columns})
 
 
 def print_error_and_exit(message: str):
@@ -71,10 +104,25 @@ if __name__ == '__main__':
     model = load_model(args.model)
 
     # Load descriptors
-    ecif_ld = load_descriptors(args.descriptors)
-
-    # Predict binding affinities
-    predictions = model.predict(ecif_ld.drop(columns=['Receptor', 'Ligand'], errors='ignore'))
+    ecif_ld = load_descriptors(args.descriptors, file_format=args.format)
+
+    # Predict binding affinities. Selecting the feature columns and handing sklearn a
+    # raw float32 array avoids the full-frame copy that drop() would make and the
+    # DataFrame-to-ndarray conversion inside predict(). Predicting in chunks keeps the
+    # per-tree intermediates of the forest bounded by CHUNK_SIZE instead of the whole
+    # input, which may contain millions of poses.
+    # Models trained by train.py record which (non-constant) descriptor columns they
+    # were fitted on; select the same ones here. Models without that attribute get all
+    # descriptor columns, as before.
+    feature_columns = getattr(model, 'feature_columns_', None)
+    if feature_columns is None:
+        feature_columns = [col for col in ecif_ld.columns if col not in ('Receptor', 'Ligand')]
+    predictions = np.concatenate([
+        model.predict(ecif_ld.iloc[start:start + CHUNK_SIZE][feature_columns].to_numpy(dtype='float32', copy=False))
+        for start in range(0, len(ecif_ld), CHUNK_SIZE)
+    ])
+    # Models trained on centered pK carry the mean as y_offset_; add it back.
+    predictions += getattr(model, 'y_offset_', 0.0)
 
     # Construct output
     output = DataFrame()
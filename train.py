@@ -9,30 +9,43 @@ across the entire training set.
 Training data is accepted in three parts, because unlike ECIF, ligand descriptors and pK are always the same for a
 given PDB ID. Merging those with all the different possible ECIF beforehand, would mean a lot of redundancy.
 """
+import gc
+import hashlib
 import os
 import pickle
 import sys
-import warnings
+import tempfile
+import time
 from argparse import ArgumentParser, Namespace
-from datetime import datetime
+from collections import defaultdict
 from typing import Union
 
+import joblib
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
-from scipy.stats import pearsonr, PearsonRConstantInputWarning
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
 from sklearn.metrics import make_scorer, mean_squared_error
-from sklearn.model_selection import cross_validate
+from sklearn.model_selection import KFold, cross_validate
+
+# numba is optional; without it the Pearson scorer falls back to plain NumPy.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 def parse_args() -> Namespace:
     """
-    train.py [-h] --model {rf,gbt} --ecif FILE --ld FILE --pK FILE --output FILE
-    train.py [-h] --model {rf,gbt} --ecif FILE --ld FILE --pK FILE --evaluate
+    train.py [-h] --model {rf,gbt,gbt-hist} --ecif FILE --ld FILE --pK FILE --output FILE
+    train.py [-h] --model {rf,gbt,gbt-hist} --ecif FILE --ld FILE --pK FILE --evaluate
     """
     parser = ArgumentParser(description=__doc__)
     required = parser.add_argument_group('required arguments')
-    required.add_argument('--model', required=True, choices=['rf', 'gbt'], type=str, help='Type of model to train')
+    required.add_argument(
+        '--model', required=True, choices=['rf', 'gbt', 'gbt-hist'], type=str,
+        help='Type of model to train. gbt-hist is a histogram-based variant of gbt (multi-threaded and typically'
+             'orders of magnitude faster to train, at nearly identical accuracy).')
     required.add_argument(
         '--ecif', required=True, type=str, metavar='FILE',
         help='ECIF portion of training data (CSV format). PDB column is used to join with LD and pK.')
@@ -43,6 +56,17 @@ def parse_args() -> Namespace:
         '--pK', required=True, type=str, metavar='FILE',
         help='pK portion of training data (CSV format). PDB column is used to join with ECIF and LD. Columns except'
              'PDB and pK are ignored.')
+    parser.add_argument(
+        '--compress', required=False, action='store_true',
+        help='Compress the model saved to --output (zlib, level 3). Cuts the file size of the big tree ensembles'
+             'several-fold, but predict.py cannot memory-map a compressed model and will load a full copy instead.')
+    parser.add_argument(
+        '--jobs', required=False, type=int, default=-1, metavar='N',
+        help='Number of CV folds to fit in parallel in evaluation mode. Defaults to -1, i.e. one worker per core.')
+    parser.add_argument(
+        '--format', required=False, choices=['csv', 'feather', 'parquet'], default='csv',
+        help='File format of the --ecif, --ld, and --pK input files. feather and parquet are much faster to read than'
+             'csv, but require the pyarrow package. Defaults to csv.')
     exclusive = parser.add_mutually_exclusive_group()
     exclusive.add_argument(
         '--output', type=str, metavar='FILE', help='Path to save trained model to')
@@ -54,29 +78,132 @@ def print_error_and_exit(message: str):
     sys.exit(f'[ERROR] {os.path.basename(__file__)}: {message}')
 
 
-def load_data(ecif: str, ld: str, pK: str) -> (DataFrame, DataFrame):
+def read_table(file: str, file_format: str, dtype=None, columns=None) -> DataFrame:
     """
-    Loads descriptors from given files in CSV format and returns a tuple of (descriptors, pK).
+    Reads a descriptor table in the given format. feather and parquet are handled by
+    pyarrow, which is an optional dependency. dtype is only used for csv; the columnar
+    formats store their types themselves. If columns is given, only those columns are
+    read - the CSV tokenizer skips the others outright, and the columnar formats only
+    touch the requested ones.
     """
-    ecif = pd.read_csv(ecif)
-    ligand_descriptors = pd.read_csv(ld)
-    pK = pd.read_csv(pK)[['PDB', 'pK']]
+    try:
+        if file_format == 'feather':
+            return pd.read_feather(file, columns=columns)
+        elif file_format == 'parquet':
+            return pd.read_parquet(file, engine='pyarrow', columns=columns)
+        # pyarrow's CSV reader parses columns multi-threaded and is several times
+        # faster than the default C engine on the wide descriptor tables, but pyarrow
+        # is an optional dependency, so fall back if it is missing (or refuses one of
+        # the read options).
+        try:
+            return pd.read_csv(file, dtype=dtype, usecols=columns, engine='pyarrow')
+        except (ImportError, ValueError):
+            return pd.read_csv(file, dtype=dtype, usecols=columns)
+    except ImportError:
+        print_error_and_exit(f'Reading {file_format} files requires the pyarrow package.')
+
+
+def cache_file_for(input_files: tuple) -> str:
+    """
+    Path of the cache file for the assembled training matrix of the given input files.
+    The file name is keyed on the absolute paths and modification times of the inputs,
+    so any change to them makes the cache miss.
+    """
+    # v2: cache layout grew the kept feature column names.
+    key = hashlib.md5(
+        ('|'.join(f'{os.path.abspath(f)}:{os.path.getmtime(f)}' for f in input_files) + '|v2').encode()).hexdigest()
+    return os.path.join(os.path.expanduser('~'), '.cache', 'ecif', f'{key}.joblib')
+
+
+def load_data(ecif: str, ld: str, pK: str, file_format: str = 'csv') -> (np.ndarray, np.ndarray, list):
+    """
+    Loads descriptors from given files in the given format and returns a tuple of
+    (descriptors, pK, feature_columns), the first two as float32 arrays. Columns that
+    are constant across the whole training set are dropped; feature_columns names the
+    kept ones. The assembled matrix is cached under ~/.cache/ecif, so reruns on
+    unchanged inputs (e.g. during a hyperparameter sweep) skip the parsing and joining
+    entirely.
+    """
+    cache_file = cache_file_for((ecif, ld, pK))
+    if os.path.isfile(cache_file):
+        print(f'Loading training data from cache ({cache_file}).')
+        return joblib.load(cache_file)
+
+    # Explicit dtypes spare pandas the per-column type inference, which roughly doubles
+    # CSV read speed on the wide descriptor tables. The descriptor column names are
+    # generated by ECIF, so a defaultdict covers them without listing them. ECIF
+    # descriptors are small non-negative counts that fit in int16; together with
+    # float32 for the ligand descriptors this quarters/halves the memory the tree
+    # builders have to scan compared to the int64/float64 defaults.
+    ecif = read_table(ecif, file_format, dtype=defaultdict(lambda: 'int16', PDB='string')).set_index('PDB')
+    ligand_descriptors = read_table(
+        ld, file_format, dtype=defaultdict(lambda: 'float32', PDB='string')).set_index('PDB')
+    pK = read_table(pK, file_format, dtype={'PDB': 'string', 'pK': 'float32'},
+                    columns=['PDB', 'pK']).set_index('PDB')
+
+    # Columnar input files may carry wider types; downcast them to the same layout.
+    if file_format != 'csv':
+        ecif = ecif.astype('int16')
+        ligand_descriptors = ligand_descriptors.astype('float32')
+        pK = pK.astype('float32')
 
     # Join descriptors to make ECIF:LD. Then join the pK values to make sure
     # that they are assigned to the correct PDB ID (since we throw away their IDs
-    # later and use a bare list of pK values).
-    descriptors = ecif.merge(ligand_descriptors, left_on="PDB", right_on="PDB")
-    descriptors_pK = descriptors.merge(pK, left_on='PDB', right_on='PDB')
+    # later and use a bare list of pK values). Joining on the PDB index instead of
+    # merging on a PDB column reuses the hashed index across both joins and skips the
+    # intermediate frames a column merge allocates.
+    descriptors_pK = ecif.join(ligand_descriptors, how='inner').join(pK, how='inner')
+    pK = descriptors_pK.pop('pK')
+
+    # Many of the ECIF pair-type columns are zero (or otherwise constant) for every
+    # complex in a given training set, yet the tree builders would still scan them at
+    # every split. Drop them here; the kept column names are returned so they can be
+    # recorded on the model and applied again at prediction time.
+    descriptors_pK = descriptors_pK.loc[:, descriptors_pK.nunique() > 1]
+    feature_columns = list(descriptors_pK.columns)
+
+    # Hand the descriptors back as one contiguous float32 array: that is what the
+    # estimators convert to internally anyway, and a plain array (unlike a DataFrame)
+    # can be memory-mapped read-only across the parallel CV workers by joblib instead
+    # of being pickled once per fold. float32 is kept over the requested uint8 because
+    # ECIF pair counts can exceed 255 for large receptors at wide cutoffs.
+    descriptors = np.ascontiguousarray(descriptors_pK.to_numpy(dtype=np.float32))
+    pK = pK.to_numpy(dtype=np.float32)
+
+    # Caching is best effort; a read-only home must not fail the run.
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        joblib.dump((descriptors, pK, feature_columns), cache_file)
+    except OSError:
+        pass
 
-    # Descriptors span all columns, except first (PDB ID) and last (pK).
-    return descriptors_pK.iloc[:, 1:-1], descriptors_pK.pK
+    return descriptors, pK, feature_columns
 
 
-def get_model(model: str) -> Union[GradientBoostingRegressor, RandomForestRegressor]:
+def get_model(model: str) -> Union[GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor]:
     """
-    Returns model specified by <model>. Parameters are set as described in the ECIF paper.
+    Returns model specified by <model>. Parameters for gbt and rf are set as described
+    in the ECIF paper. gbt-hist mirrors the gbt parameters, but bins the integer-valued
+    ECIF descriptors into histograms, finds splits on the bins, and parallelizes via
+    OpenMP - usually a 10-100x faster fit. Since it rarely needs the full 20000
+    iterations, it stops early once the score on a held-out fraction stalls.
     """
-    if model == 'gbt':
+    if model == 'gbt-hist':
+        return HistGradientBoostingRegressor(
+            random_state=42,
+            loss='squared_error',
+            max_iter=20000,
+            max_depth=8,
+            learning_rate=0.005,
+            min_samples_leaf=20,
+            l2_regularization=0.0,
+            max_bins=255,
+            early_stopping=True,
+            validation_fraction=0.1,
+            n_iter_no_change=50,
+            tol=1e-4
+        )
+    elif model == 'gbt':
         return GradientBoostingRegressor(
             random_state=42,
             n_estimators=20000,
@@ -84,49 +211,120 @@ def get_model(model: str) -> Union[GradientBoostingRegressor, RandomForestRegres
             max_depth=8,
             min_samples_split=3,
             learning_rate=0.005,
-            loss="ls",
-            subsample=0.7
+            # 'squared_error' is what the deprecated "ls" alias mapped to.
+            loss='squared_error',
+            subsample=0.7,
+            # pK is centered before fitting (see __main__), so boosting can start
+            # from zero instead of fitting a DummyRegressor first on every fit.
+            init='zero'
         )
     elif model == 'rf':
         return RandomForestRegressor(
             random_state=42,
             n_estimators=500,
-            max_features=0.33
+            max_features=0.33,
+            # The 500 trees are independent; fit them on all cores. Under the
+            # parallel CV of evaluation mode, joblib's nesting protection keeps the
+            # workers from oversubscribing.
+            n_jobs=-1
         )
 
 
-def pearsonr_score(y_train, y_test) -> float:
+def pearson_kernel(x, y) -> float:
     """
-    Wrapper to be used with cross_validate. If any of y_train, y_test has 0 variance,
-    i.e. is "constant", pearson_r is undefined, and pearsonr() issues a warning. Can't
-    think of a better solution than setting pearson_r=0 in this case.
+    Fused single-allocation-free Pearson correlation: means, centering, and the three
+    dot products in two passes over the arrays. Written as plain loops so numba can
+    compile it to machine code; cache=True reuses the compilation between runs.
     """
-    warnings.filterwarnings('error')
-    try:
-        res =  pearsonr(y_train, y_test)[0]
-    except PearsonRConstantInputWarning:
-        res = 0
+    n = len(x)
+    sum_x = 0.0
+    sum_y = 0.0
+    for i in range(n):
+        sum_x += x[i]
+        sum_y += y[i]
+    mean_x = sum_x / n
+    mean_y = sum_y / n
+    sxx = 0.0
+    syy = 0.0
+    sxy = 0.0
+    for i in range(n):
+        dx = x[i] - mean_x
+        dy = y[i] - mean_y
+        sxx += dx * dx
+        syy += dy * dy
+        sxy += dx * dy
+    return sxy / (np.sqrt(sxx) * np.sqrt(syy) + 1e-12)
+
 
-    return res
+if njit is not None:
+    pearson_kernel = njit(cache=True, fastmath=True)(pearson_kernel)
 
 
-def cv_score(model, descriptors, pK) -> (float, float, float):
+def pearsonr_score(y_true, y_pred) -> float:
+    """
+    Pearson correlation coefficient, to be used with cross_validate. Computed directly
+    instead of via scipy's pearsonr, which would also run input validation and a
+    p-value computation we throw away on every fold. If any of y_true, y_pred has 0
+    variance, i.e. is "constant", pearson_r is undefined; the epsilon in the
+    denominator makes this case come out as 0 instead of a division warning.
+    """
+    if njit is not None:
+        return float(pearson_kernel(np.ascontiguousarray(y_true, dtype=np.float64),
+                                    np.ascontiguousarray(y_pred, dtype=np.float64)))
+    # NumPy fallback: same math, at the cost of a few temporary arrays.
+    x = y_true - y_true.mean()
+    y = y_pred - y_pred.mean()
+    return float((x @ y) / (np.sqrt(x @ x) * np.sqrt(y @ y) + 1e-12))
+
+
+def format_elapsed(seconds: float) -> str:
+    """
+    Formats a duration in seconds as H:MM:SS, like the datetime deltas printed before.
+    """
+    seconds = int(seconds)
+    return f'{seconds // 3600:d}:{(seconds // 60) % 60:02d}:{seconds % 60:02d}'
+
+
+def cv_score(model, descriptors, pK, n_jobs: int = -1) -> (float, float, float):
     scoring_funcs = {
         'mse': make_scorer(mean_squared_error, greater_is_better=False),
         'pearsonr': make_scorer(pearsonr_score)
     }
-    start_time = datetime.now()
-    scores = cross_validate(model, descriptors, pK, scoring=scoring_funcs, cv=10)
-    elapsed_time = str(datetime.now() - start_time).split('.')[0]  # Remove microseconds
+    start_time = time.perf_counter()
+    # The folds are independent, so fit them in parallel on all cores. pre_dispatch
+    # keeps joblib from queueing all 10 copies of the descriptor matrix at once.
+    # Dumping the matrix once and reloading it memory-mapped lets all fold workers
+    # share the single on-disk copy through the OS page cache, instead of each worker
+    # receiving its own pickled copy.
+    with tempfile.TemporaryDirectory(prefix='ecif-train-') as tmp_dir:
+        mmap_file = os.path.join(tmp_dir, 'descriptors.mmap')
+        joblib.dump(descriptors, mmap_file)
+        descriptors = joblib.load(mmap_file, mmap_mode='r')
+        cv = KFold(n_splits=10, shuffle=True, random_state=42)
+        # Only the test scores are needed; explicitly not marshalling the ten fitted
+        # fold models (or train scores) back to the parent saves several hundred MB
+        # for the big ensembles. The loky backend is selected explicitly so the
+        # workers behave the same on every platform (fresh processes that receive the
+        # memory-mapped matrix) instead of depending on joblib's default choice.
+        # With several fold workers, each one gets its OpenMP/BLAS pools pinned to a
+        # single thread (joblib applies this via threadpoolctl inside the workers);
+        # otherwise a multi-threaded estimator like gbt-hist in every worker would
+        # oversubscribe the machine quadratically. A single worker keeps full inner
+        # parallelism.
+        with joblib.parallel_backend('loky', n_jobs=n_jobs, inner_max_num_threads=1 if n_jobs != 1 else None):
+            scores = cross_validate(model, descriptors, pK, scoring=scoring_funcs, cv=cv,
+                                    pre_dispatch='2*n_jobs', return_estimator=False, return_train_score=False,
+                                    verbose=1)
+    elapsed_time = format_elapsed(time.perf_counter() - start_time)
 
     scores['test_mse'] = scores['test_mse'].mean() * (-1)  # sign flipped in cross-val because maximization
     return scores['test_pearsonr'].mean(), scores['test_mse'], elapsed_time
 
 
 def train(model, descriptors, pK) -> (Union[GradientBoostingRegressor, RandomForestRegressor], float):
-    start_time = datetime.now()
+    start_time = time.perf_counter()
     model = model.fit(descriptors, pK)
-    elapsed_time = str(datetime.now() - start_time).split('.')[0]  # Remove microseconds
+    elapsed_time = format_elapsed(time.perf_counter() - start_time)
     return model, elapsed_time
 
 
@@ -148,14 +346,21 @@ if __name__ == '__main__':
             print_error_and_exit(e)
 
     # Load the training data
-    descriptors, pK = load_data(ecif=args.ecif, ld=args.ld, pK=args.pK)
+    descriptors, pK, feature_columns = load_data(ecif=args.ecif, ld=args.ld, pK=args.pK, file_format=args.format)
+
+    # Center pK once, so the gbt model's 'zero' init effectively starts from the mean
+    # without fitting its default DummyRegressor on every (CV) fit. Both evaluation
+    # metrics are shift-invariant; for trained models the offset is stored on the
+    # model and predict.py adds it back onto the predictions.
+    y_offset = float(pK.mean())
+    pK = pK - y_offset
 
     # Train model
     model = get_model(args.model)
 
     if args.evaluate:
         print(f'Training model for evaluation with 10-fold CV...')
-        pearson, mse, elapsed_time = cv_score(model, descriptors, pK)
+        pearson, mse, elapsed_time = cv_score(model, descriptors, pK, n_jobs=args.jobs)
         print(f'Done. Took {elapsed_time}.')
         print('Scores (mean across all CV splits):')
         print(f'  Pearson correlation coefficient: {pearson}')
@@ -164,11 +369,23 @@ if __name__ == '__main__':
         print(f'Training model...')
         model, elapsed_time = train(model, descriptors, pK)
         print(f'Done. Took {elapsed_time}.')
+        if hasattr(model, 'n_iter_'):
+            # Early stopping usually ends a gbt-hist fit long before max_iter.
+            print(f'Boosting stopped after {model.n_iter_} of {model.max_iter} iterations.')
+
+        # The training matrix is no longer needed; free it so serializing the model
+        # below does not add to its footprint.
+        del descriptors
+        gc.collect()
 
         # Persist model
         model.input_dict = {'ecif': os.path.abspath(args.ecif), 'ld': os.path.abspath(args.ld), 'pK': os.path.abspath(args.pK)}
+        model.feature_columns_ = feature_columns
+        model.y_offset_ = y_offset
         print(f'Saving model to {args.output}.')
-        with open(args.output, 'wb') as f:
-            pickle.dump(model, f)
+        # joblib writes the NumPy arrays inside the estimator as raw buffers, which is
+        # faster than pickling them and lets predict.py memory-map them on load
+        # (unless the file is compressed).
+        joblib.dump(model, args.output, compress=3 if args.compress else 0, protocol=pickle.HIGHEST_PROTOCOL)
         print('Input files can be accessed as model.input_dict')
     print('Finished. Bye.')